@@ -10,9 +10,14 @@ import logging
 import logging.handlers
 import json
 import os
+import queue
 import re
+import socket
+import sys
 import time
 import fcntl
+import gzip
+import binascii
 from collections import deque
 
 VERSION_NUMBER = "0.4.0"
@@ -35,6 +40,30 @@ CACHE_KEY = 'cache'
 LOCK_KEY = 'lock'
 SHARED_KEY = 'shared'
 OVERRIDE_KEY = 'override'
+ARCHIVE_KEY = 'archive'
+
+ARCHIVE_PATH_KEY = 'path'
+ARCHIVE_COMPRESS_KEY = 'compress'
+ARCHIVE_RETAIN_KEY = 'retain'
+ARCHIVE_FOLD_KEY = 'fold'
+ARCHIVE_INDEX = 'index.jsonl'
+ARCHIVE_RETAIN = 7
+ARCHIVE_FOLD = 100
+ARCHIVE_TAIL_SIZE = 64
+SEGMENT_ID = 'id'
+SEGMENT_FILE = 'file'
+SEGMENT_OFFSET = 'offset'
+SEGMENT_LENGTH = 'length'
+SEGMENT_BASE = 'base'
+SEGMENT_TAIL = 'tail'
+LEASE_KEY = 'lease'
+
+LEASE_PATH_KEY = 'path'
+LEASE_TTL_KEY = 'ttl'
+LEASE_OWNER_KEY = 'owner'
+LEASE_TOKEN = 'token'
+LEASE_EXPIRES = 'expires'
+LEASE_TTL = 300
 
 TWILIO_SECTION = 'twilio'
 TO_KEY = 'to'
@@ -63,6 +92,58 @@ LOG_LEVEL = logging.INFO
 MAX_ITEM_FAILURES = 100
 
 
+def _filter_setup(logger, configuration):
+    """
+    Compile the whitelist/blacklist filters of a configuration.
+
+    Whitelist applied first, blacklist second (so whitelist _can_ be initial)
+    """
+    filters = []
+    for key, is_whitelist in [(WHITELIST_KEY, True), (BLACKLIST_KEY, False)]:
+        for entry in configuration[key]:
+            logger.debug("filter %s (whitelist: %s)", entry, is_whitelist)
+            compiled = re.compile(entry)
+            filters.append((is_whitelist, compiled))
+    return filters
+
+
+def _is_output(logger, raw_message, filters, has_whitelist, debugging):
+    """Check a message against the whitelist/blacklist filters."""
+    whitelist_matches = 0
+    blacklist_matches = 0
+    for item in filters:
+        regex = item[1]
+        is_whitelisted = item[0]
+        result = regex.match(raw_message)
+        was_match = result is not None
+        if debugging:
+            logger.debug('%s match %s? %s (wl: %s)',
+                         regex,
+                         raw_message,
+                         was_match,
+                         is_whitelisted)
+
+        if is_whitelisted:
+            if was_match:
+                whitelist_matches += 1
+        else:
+            if was_match:
+                blacklist_matches += 1
+
+    blacklisted = blacklist_matches > 0
+    whitelisted = True
+    if has_whitelist:
+        whitelisted = whitelist_matches > 0
+
+    do_output = whitelisted
+    if do_output:
+        do_output = not blacklisted
+
+    if debugging:
+        logger.debug('%s will be output ? %s', raw_message, do_output)
+    return do_output
+
+
 def process_file(logger, file_bytes, cache_object, configuration):
     """
     Process the binary log file bytes.
@@ -70,33 +151,38 @@ def process_file(logger, file_bytes, cache_object, configuration):
     Perform the actual reading of the file bytes and conversion
     to an output message set.
     """
+    return process_files(logger, file_bytes, [(cache_object,
+                                               configuration)])[0]
+
+
+def process_files(logger, file_bytes, rule_sets):
+    """
+    Process the binary log file bytes for multiple configurations.
+
+    Each record is decoded once and then checked against every
+    (cache object, configuration) rule set, the configurations have to
+    share the record layout (see _check_shared). Returns an output
+    message set per rule set.
+    """
+    configuration = rule_sets[0][1]
     offset = 0
-    last_reported = []
-    filters = []
-    has_whitelist = False
-    start_date = datetime.datetime.strptime(configuration[START_KEY],
-                                            DATE_FORMAT)
     chunking = configuration[SIZE_KEY]
     pattern = configuration[PATTERN_KEY]
     message_idx = configuration[MESSAGE_KEY]
     time_idx = configuration[TIME_KEY]
-
-    def _filter_setup(is_whitelist, entry, filter_set):
-        logger.debug("filter {0} (whitelist: {1})".format(entry, is_whitelist))
-        compiled = re.compile(entry)
-        filter_set.append((is_whitelist, compiled))
-
-    # Whitelist applied first, blacklist second (so whitelist _can_ be initial)
-    for item in configuration[WHITELIST_KEY]:
-        has_whitelist = True
-        _filter_setup(True, item, filters)
-
-    for item in configuration[BLACKLIST_KEY]:
-        _filter_setup(False, item, filters)
-
-    cache_time = None
-    if cache_object is not None:
-        cache_time = cache_object[OBJECT_TIME]
+    # Checked once, the per-record debugging is skipped when not enabled
+    debugging = logger.isEnabledFor(logging.DEBUG)
+
+    checks = []
+    for cache_object, rule_config in rule_sets:
+        start_date = datetime.datetime.strptime(rule_config[START_KEY],
+                                                DATE_FORMAT)
+        filters = _filter_setup(logger, rule_config)
+        has_whitelist = len(rule_config[WHITELIST_KEY]) > 0
+        cache_time = None
+        if cache_object is not None:
+            cache_time = cache_object[OBJECT_TIME]
+        checks.append((start_date, filters, has_whitelist, cache_time, []))
 
     while offset < len(file_bytes):
         all_bytes = file_bytes[0 + offset: chunking + offset]
@@ -106,39 +192,16 @@ def process_file(logger, file_bytes, cache_object, configuration):
         # expects ascii here
         raw_data = [x for x in unpacked[message_idx] if x != 0]
         raw_message = array.array('B', raw_data).tostring().decode('ascii')
-
-        whitelist_matches = 0
-        blacklist_matches = 0
-        for item in filters:
-            regex = item[1]
-            is_whitelisted = item[0]
-            result = regex.match(raw_message)
-            was_match = result is not None
-            logger.debug('{0} match {1}? {2} (wl: {3})'.format(regex,
-                                                               raw_message,
-                                                               was_match,
-                                                               is_whitelisted))
-
-            if is_whitelisted:
-                if was_match:
-                    whitelist_matches += 1
-            else:
-                if was_match:
-                    blacklist_matches += 1
-
-        blacklisted = blacklist_matches > 0
-        whitelisted = True
-        if has_whitelist:
-            whitelisted = whitelist_matches > 0
-
-        do_output = whitelisted
-        if do_output:
-            do_output = not blacklisted
-
-        logger.debug('{0} will be output ? {1}'.format(raw_message, do_output))
-        if do_output:
+        seconds = unpacked[time_idx]
+
+        for start_date, filters, has_whitelist, cache_time, reported in checks:
+            if not _is_output(logger,
+                              raw_message,
+                              filters,
+                              has_whitelist,
+                              debugging):
+                continue
             obj = {}
-            seconds = unpacked[time_idx]
             display_time = start_date + datetime.timedelta(seconds=seconds)
 
             # We can just sort and use the seconds offset
@@ -151,10 +214,11 @@ def process_file(logger, file_bytes, cache_object, configuration):
             obj[OBJECT_VIS_TIME] = str(display_time)
 
             if cache_time is None or obj[OBJECT_TIME] > cache_time:
-                logger.debug(obj)
-                last_reported.append(obj)
+                if debugging:
+                    logger.debug(obj)
+                reported.append(obj)
         offset += chunking
-    return last_reported
+    return [check[4] for check in checks]
 
 
 class Message(object):
@@ -474,7 +538,7 @@ def send_message(logger, message_list, config, dry_run):
         callback = current_object[2]
         obj = current_object[3]
         try:
-            logger.info("{0} to {1}".format(function, item))
+            logger.info("%s to %s", function, item)
             callback(dry_run, obj, item)
         except Exception as e:
             logger.warn('unable to send message to %s' % item)
@@ -536,11 +600,9 @@ def overriding(shared, config, override, logger):
 def _get_data_bytes(logger, file_name, test_data):
     """Get the data to use for execution."""
     if file_name is None and test_data is None:
-        print('a file or test value is required')
-        exit(-1)
+        raise Exception('a file or test value is required')
     if file_name is not None and test_data is not None:
-        print('only a file OR a test value can be passed')
-        exit(-1)
+        raise Exception('only a file OR a test value can be passed')
     bytes = list()
     if file_name is not None:
         logger.info('reading file: %s' % file_name)
@@ -559,6 +621,501 @@ def _get_data_bytes(logger, file_name, test_data):
     return bytes
 
 
+def _write_atomic(file_name, contents):
+    """Replace a file's contents atomically."""
+    temp_file = file_name + '.tmp'
+    with open(temp_file, 'w') as f:
+        f.write(contents)
+    os.rename(temp_file, file_name)
+
+
+def _load_archive_index(logger, archive_dir):
+    """Load the segment index for an archive (empty if new)."""
+    index_file = os.path.join(archive_dir, ARCHIVE_INDEX)
+    if not os.path.exists(index_file):
+        return []
+    with open(index_file, 'r') as f:
+        lines = [x for x in f.read().split('\n') if len(x) > 0]
+    index = []
+    for idx, line in enumerate(lines):
+        try:
+            index.append(json.loads(line))
+        except ValueError:
+            # A partial (last) entry is an append that never finished
+            if idx != len(lines) - 1:
+                raise
+            logger.warn('ignoring partial archive index entry')
+    return index
+
+
+def _append_archive_index(archive_dir, segment):
+    """Append a segment to the index for an archive."""
+    index_file = os.path.join(archive_dir, ARCHIVE_INDEX)
+    with open(index_file, 'a') as f:
+        f.write(json.dumps(segment) + '\n')
+
+
+def _save_archive_index(archive_dir, index):
+    """Atomically replace the segment index for an archive."""
+    index_file = os.path.join(archive_dir, ARCHIVE_INDEX)
+    _write_atomic(index_file, ''.join([json.dumps(x) + '\n' for x in index]))
+
+
+def _read_segment(archive_dir, segment):
+    """Read the raw bytes of an archived segment."""
+    segment_file = os.path.join(archive_dir, segment[SEGMENT_FILE])
+    opener = open
+    if segment_file.endswith('.gz'):
+        opener = gzip.open
+    with opener(segment_file, 'rb') as f:
+        return f.read()
+
+
+def _write_segment(logger, archive_dir, segment_name, data, compress):
+    """Write the raw bytes of a segment, returns the segment file name."""
+    opener = open
+    if compress:
+        segment_name += '.gz'
+        opener = gzip.open
+    logger.debug('writing segment {0} ({1} bytes)'.format(segment_name,
+                                                          len(data)))
+    with opener(os.path.join(archive_dir, segment_name), 'wb') as f:
+        f.write(data)
+    return segment_name
+
+
+def _restore_segments(logger, archive_dir, segments):
+    """Concatenate the bytes of a chain of segments (base first)."""
+    restored = bytearray()
+    for segment in segments:
+        if segment[SEGMENT_FILE] is not None:
+            logger.debug('restoring segment %s' % segment[SEGMENT_FILE])
+            restored.extend(_read_segment(archive_dir, segment))
+    return restored
+
+
+def _get_tail(data, end):
+    """Get the (hex) tail of the data ending at an offset."""
+    tail = data[max(0, end - ARCHIVE_TAIL_SIZE):end]
+    return binascii.hexlify(tail).decode('ascii')
+
+
+def archive_snapshot(logger, file_bytes, configuration, snapshot_id=None):
+    """
+    Archive a snapshot of the binary log file bytes.
+
+    Only the bytes appended since the last archived snapshot are stored
+    (as a new segment), a full base segment is written when the log
+    no longer starts with what was previously archived.
+    """
+    settings = configuration[ARCHIVE_KEY]
+    check_parameter(ARCHIVE_PATH_KEY, settings, subsections=[ARCHIVE_KEY])
+    check_parameter(ARCHIVE_COMPRESS_KEY, settings, False)
+    check_parameter(ARCHIVE_RETAIN_KEY, settings, ARCHIVE_RETAIN)
+    check_parameter(ARCHIVE_FOLD_KEY, settings, ARCHIVE_FOLD)
+    archive_dir = settings[ARCHIVE_PATH_KEY]
+    if not os.path.exists(archive_dir):
+        logger.info('creating archive %s' % archive_dir)
+        os.makedirs(archive_dir)
+    if snapshot_id is None:
+        snapshot_id = int(time.time())
+    data = bytearray(file_bytes)
+    index = _load_archive_index(logger, archive_dir)
+    if len(index) > 0 and snapshot_id <= index[-1][SEGMENT_ID]:
+        # Snapshot ids have to be unique (and only count up)
+        snapshot_id = index[-1][SEGMENT_ID] + 1
+    is_base = True
+    offset = 0
+    if len(index) > 0:
+        last = index[-1]
+        end = last[SEGMENT_OFFSET] + last[SEGMENT_LENGTH]
+        if len(data) >= end and _get_tail(data, end) == last[SEGMENT_TAIL]:
+            is_base = False
+            offset = end
+        else:
+            logger.warn('log does not match archive, writing new base')
+
+    segment = {}
+    segment[SEGMENT_ID] = snapshot_id
+    segment[SEGMENT_OFFSET] = offset
+    segment[SEGMENT_LENGTH] = len(data) - offset
+    segment[SEGMENT_BASE] = is_base
+    segment[SEGMENT_TAIL] = _get_tail(data, len(data))
+    segment[SEGMENT_FILE] = None
+    if segment[SEGMENT_LENGTH] > 0 or is_base:
+        segment[SEGMENT_FILE] = _write_segment(
+            logger,
+            archive_dir,
+            'seg-{0}.bin'.format(snapshot_id),
+            data[offset:],
+            settings[ARCHIVE_COMPRESS_KEY])
+    index.append(segment)
+    retained, expired = _expire_archive(logger,
+                                        archive_dir,
+                                        index,
+                                        settings,
+                                        snapshot_id)
+    # The index can not reference removed segments (even on a crash)
+    if retained is index:
+        _append_archive_index(archive_dir, segment)
+    else:
+        _save_archive_index(archive_dir, retained)
+    for segment_name in expired:
+        logger.info('expiring segment %s' % segment_name)
+        os.remove(os.path.join(archive_dir, segment_name))
+    return snapshot_id
+
+
+def _expire_archive(logger, archive_dir, index, settings, snapshot_id):
+    """
+    Expire archived snapshots older than the retention (days).
+
+    Segment chains (a base and its deltas) are removed once they end
+    before the chain of the oldest retained snapshot. Expired snapshots
+    in that chain are still needed to restore it, they are only folded
+    into a new base (a full copy) once 'fold' of them have accumulated.
+    Returns the retained index (the same index if nothing expired) and
+    the segment files that can be removed (once the index is saved).
+    """
+    retain = settings[ARCHIVE_RETAIN_KEY]
+    if retain <= 0:
+        return index, []
+    cutoff = snapshot_id - (retain * 24 * 60 * 60)
+    # Never expire the latest snapshot, it is the next delta's parent
+    first = len(index) - 1
+    for idx, segment in enumerate(index):
+        if segment[SEGMENT_ID] >= cutoff:
+            first = idx
+            break
+    base = first
+    while not index[base][SEGMENT_BASE]:
+        base -= 1
+    if base == 0 and first < settings[ARCHIVE_FOLD_KEY]:
+        return index, []
+    expired = index[:base]
+    retained = index[base:]
+    if first - base >= settings[ARCHIVE_FOLD_KEY]:
+        chain = index[base:first + 1]
+        logger.info('folding {0} segments into a base for {1}'.format(
+            len(chain),
+            index[first][SEGMENT_ID]))
+        data = _restore_segments(logger, archive_dir, chain)
+        folded = dict(index[first])
+        folded[SEGMENT_OFFSET] = 0
+        folded[SEGMENT_LENGTH] = len(data)
+        folded[SEGMENT_BASE] = True
+        folded[SEGMENT_FILE] = _write_segment(
+            logger,
+            archive_dir,
+            'base-{0}.bin'.format(folded[SEGMENT_ID]),
+            data,
+            settings[ARCHIVE_COMPRESS_KEY])
+        expired = index[:first + 1]
+        retained = [folded] + index[first + 1:]
+    expired = [x[SEGMENT_FILE] for x in expired if x[SEGMENT_FILE] is not None]
+    return retained, expired
+
+
+def restore_snapshot(logger, configuration, snapshot_id):
+    """Reconstruct the bytes of an archived snapshot."""
+    settings = configuration[ARCHIVE_KEY]
+    check_parameter(ARCHIVE_PATH_KEY, settings, subsections=[ARCHIVE_KEY])
+    archive_dir = settings[ARCHIVE_PATH_KEY]
+    index = _load_archive_index(logger, archive_dir)
+    target = None
+    for idx, segment in enumerate(index):
+        if segment[SEGMENT_ID] == snapshot_id:
+            target = idx
+    if target is None:
+        raise Exception("unknown snapshot: {0}".format(snapshot_id))
+    base = target
+    while not index[base][SEGMENT_BASE]:
+        base -= 1
+    return _restore_segments(logger, archive_dir, index[base:target + 1])
+
+
+def _lease_settings(configuration):
+    """Get the lease settings (with defaults) from the configuration."""
+    settings = configuration[LEASE_KEY]
+    check_parameter(LEASE_PATH_KEY,
+                    settings,
+                    configuration[CACHE_KEY] + '.lease')
+    check_parameter(LEASE_TTL_KEY, settings, LEASE_TTL)
+    check_parameter(LEASE_OWNER_KEY, settings, socket.gethostname())
+    return settings
+
+
+def _read_lease(lease_file):
+    """Read the current lease record (None if there isn't one)."""
+    if not os.path.exists(lease_file):
+        return None
+    with open(lease_file, 'r') as f:
+        return json.loads(f.read())
+
+
+def _lock_lease(lease_file):
+    """Exclusively lock the lease (returns the lock file to unlock)."""
+    fd = open(lease_file + '.lock', 'a')
+    fcntl.lockf(fd.fileno(), fcntl.LOCK_EX)
+    return fd
+
+
+def _unlock_lease(fd):
+    """Unlock the lease."""
+    fcntl.lockf(fd.fileno(), fcntl.LOCK_UN)
+    fd.close()
+
+
+def _cache_token(configuration):
+    """Get the fencing token stored in the cache (0 if there isn't one)."""
+    cache = configuration[CACHE_KEY]
+    if not os.path.exists(cache):
+        return 0
+    with open(cache, 'r') as cache_file:
+        cache_object = json.loads(cache_file.read())
+    if LEASE_TOKEN not in cache_object:
+        return 0
+    return cache_object[LEASE_TOKEN]
+
+
+def acquire_lease(logger, configuration, now=None):
+    """
+    Acquire (or renew) the lease to scan and dispatch.
+
+    Returns the fencing token when this instance holds the lease,
+    None when another owner holds an unexpired lease.
+    """
+    settings = _lease_settings(configuration)
+    lease_file = settings[LEASE_PATH_KEY]
+    owner = settings[LEASE_OWNER_KEY]
+    if now is None:
+        now = time.time()
+    fd = _lock_lease(lease_file)
+    try:
+        lease = _read_lease(lease_file)
+        if lease is not None and lease[LEASE_EXPIRES] > now:
+            token = lease[LEASE_TOKEN]
+            if lease[LEASE_OWNER_KEY] != owner:
+                logger.info('lease held by {0} (token {1})'.format(
+                    lease[LEASE_OWNER_KEY],
+                    token))
+                return None
+        else:
+            token = 0
+            if lease is not None:
+                token = lease[LEASE_TOKEN]
+                logger.info('lease expired for {0} (token {1})'.format(
+                    lease[LEASE_OWNER_KEY],
+                    token))
+            # A new lease has to fence off any holder that wrote the cache
+            # (even if the lease record itself was lost)
+            token = max(token, _cache_token(configuration)) + 1
+        renewed = {}
+        renewed[LEASE_OWNER_KEY] = owner
+        renewed[LEASE_TOKEN] = token
+        renewed[LEASE_EXPIRES] = now + settings[LEASE_TTL_KEY]
+        _write_atomic(lease_file, json.dumps(renewed))
+        logger.debug('lease held (token %s)' % token)
+        return token
+    finally:
+        _unlock_lease(fd)
+
+
+def _renew_lease(logger, configuration, token):
+    """Renew the lease (if in use), fail if it is no longer held."""
+    if token is None:
+        return
+    if acquire_lease(logger, configuration) != token:
+        raise Exception("lease lost (token {0})".format(token))
+
+
+def _check_cache_token(cache_object, token):
+    """Fail if the cache was written by a newer lease holder."""
+    if token is None or cache_object is None:
+        return
+    if LEASE_TOKEN in cache_object and cache_object[LEASE_TOKEN] > token:
+        raise Exception("cache written by a newer lease (token {0})".format(
+            cache_object[LEASE_TOKEN]))
+
+
+def write_cache(logger, configuration, cache_object, token=None):
+    """
+    Write the last reported object out to the cache.
+
+    With a lease the fencing token is stored in the cache, the write
+    is refused unless the lease is still held (checked and written
+    while the lease is locked) and the cache has no newer token.
+    """
+    cache = configuration[CACHE_KEY]
+    if token is None:
+        with open(cache, 'w') as cache_write:
+            cache_write.write(json.dumps(cache_object))
+        return
+    settings = _lease_settings(configuration)
+    lease_file = settings[LEASE_PATH_KEY]
+    fd = _lock_lease(lease_file)
+    try:
+        lease = _read_lease(lease_file)
+        held = lease is not None
+        held = held and lease[LEASE_OWNER_KEY] == settings[LEASE_OWNER_KEY]
+        held = held and lease[LEASE_TOKEN] == token
+        held = held and lease[LEASE_EXPIRES] > time.time()
+        if not held:
+            raise Exception("lease lost (token {0})".format(token))
+        cache_token = {}
+        cache_token[LEASE_TOKEN] = _cache_token(configuration)
+        _check_cache_token(cache_token, token)
+        cache_object[LEASE_TOKEN] = token
+        _write_atomic(cache, json.dumps(cache_object))
+    finally:
+        _unlock_lease(fd)
+
+
+def _load_config(logger, config_name):
+    """Load a configuration file (and any shared configuration)."""
+    config_file = None
+    with open(config_name, 'r') as f:
+        logger.debug('loading config')
+        config_file = json.loads(f.read())
+        logger.debug(config_file)
+
+    if SHARED_KEY in config_file:
+        shared_value = config_file[SHARED_KEY]
+        logger.debug('loading shared config')
+        if len(shared_value) > 0:
+            with open(shared_value, 'r') as f:
+                shared_config = json.loads(f.read())
+                logger.debug(shared_config)
+                do_override = True
+                if OVERRIDE_KEY in config_file:
+                    do_override = config_file[OVERRIDE_KEY]
+
+                # Replay this 'over' the given, it overrides
+                config_file = overriding(shared_config,
+                                         config_file,
+                                         do_override,
+                                         logger)
+
+    check_parameter(SIZE_KEY, config_file)
+    check_parameter(START_KEY, config_file, '1970-01-01 00:00:00')
+    check_parameter(PATTERN_KEY, config_file)
+    check_parameter(MESSAGE_KEY, config_file)
+    check_parameter(TIME_KEY, config_file)
+    check_parameter(CACHE_KEY, config_file)
+    check_parameter(WHITELIST_KEY, config_file, [])
+    check_parameter(BLACKLIST_KEY, config_file, [])
+    logger.debug('final config:')
+    logger.debug(config_file)
+    return config_file
+
+
+def _check_shared(configs):
+    """
+    Check multiple configs can share a scan of the log.
+
+    They must have the same record layout and can not share a cache
+    or an archive.
+    """
+    for key in [SIZE_KEY, PATTERN_KEY, MESSAGE_KEY, TIME_KEY]:
+        for config_file in configs:
+            if config_file[key] != configs[0][key]:
+                raise Exception("configs must share the record layout: %s"
+                                % key)
+    caches = [x[CACHE_KEY] for x in configs]
+    archives = []
+    for config_file in configs:
+        if ARCHIVE_KEY in config_file:
+            check_parameter(ARCHIVE_PATH_KEY,
+                            config_file[ARCHIVE_KEY],
+                            subsections=[ARCHIVE_KEY])
+            archives.append(config_file[ARCHIVE_KEY][ARCHIVE_PATH_KEY])
+    for key, paths in [(CACHE_KEY, caches), (ARCHIVE_KEY, archives)]:
+        paths = [os.path.abspath(x) for x in paths]
+        if len(set(paths)) != len(paths):
+            raise Exception("configs can not share a {0} location".format(
+                key))
+
+
+def _read_cache(logger, config_file, force, lease_token=None):
+    """Read the last reported object from the cache (if any)."""
+    last_obj = None
+    cache = config_file[CACHE_KEY]
+    logger.debug('using cache: %s' % cache)
+    if os.path.exists(cache) and not force:
+        with open(cache, 'r') as cache_file:
+            last_obj = json.loads(cache_file.read())
+            logger.info('reading cache in, object: ')
+            logger.info(last_obj)
+    _check_cache_token(last_obj, lease_token)
+    return last_obj
+
+
+def _report(logger, args, config_file, results, lease_token):
+    """Send out any new messages and update the cache."""
+    results.sort(key=lambda x: x[OBJECT_TIME], reverse=True)
+    messages = []
+    latest_message = None
+    for item in results:
+        if latest_message is None:
+            latest_message = item
+
+        message_text = item[OBJECT_MESSAGE]
+        if args.loglimit <= 0 or len(messages) < args.loglimit:
+            logger.debug(item)
+            logger.warn(message_text)
+        messages.append(message_text)
+
+    unlogged = len(messages) - args.loglimit
+    if args.loglimit > 0 and unlogged > 0:
+        logger.warn('%s more new messages (not logged)', unlogged)
+
+    if len(messages) > 0:
+        dry_run = args.dryrun
+        locking = LOCK_KEY in config_file
+        lock_file = None
+        if locking:
+            lock_file = config_file[LOCK_KEY]
+            if not os.path.exists(lock_file):
+                logger.info('creating lock file %s' % lock_file)
+                # Creating the file if it doesn't exist
+                with open(lock_file, 'w+') as fd:
+                    fd.write('')
+
+        fd = None
+        try:
+            if locking:
+                logger.debug('performing lock operation')
+                fd = open(lock_file, 'w')
+                fcntl.lockf(fd.fileno(), fcntl.LOCK_EX)
+
+            # Critical section for messaging outputs
+            if args.console:
+                config_file[CONSOLE_SECTION] = {}
+            _renew_lease(logger, config_file, lease_token)
+            if not send_message(logger, messages, config_file, dry_run):
+                # Prevent writing out the 'latest' if this doesn't work
+                raise Exception("unable to report message out")
+        finally:
+            if locking and fd is not None:
+                logger.debug('unlocking...')
+                fcntl.lockf(fd.fileno(), fcntl.LOCK_UN)
+                fd.close()
+
+    if latest_message is not None:
+        logger.info('new message detected')
+        last_json = json.dumps(latest_message)
+        logger.info(last_json)
+        write_cache(logger, config_file, latest_message, lease_token)
+
+
+def _done(logger, exit_code, listener=None):
+    """Finish execution (flushing any queued log records)."""
+    logger.info('done')
+    if listener is not None:
+        listener.stop()
+    exit(exit_code)
+
+
 def main():
     """
     Main entry point.
@@ -569,6 +1126,7 @@ def main():
     logger.setLevel(LOG_LEVEL)
     formatter = logging.Formatter("%(asctime)s - %(levelname)s - %(message)s")
     exit_code = -1
+    listener = None
     try:
         parser = argparse.ArgumentParser(
             description='Parse and report any binary log messages.')
@@ -583,7 +1141,9 @@ def main():
                             action='store_true',
                             dest='debug')
         parser.add_argument('--config',
-                            help='configuration file',
+                            help='configuration file(s), one log scan is '
+                                 'shared by all configs',
+                            nargs='+',
                             required=True)
         parser.add_argument('--log',
                             help='log file',
@@ -602,121 +1162,119 @@ def main():
                             help='force output, ignore cache',
                             action='store_true',
                             dest='force')
+        parser.add_argument('--restore',
+                            help='write an archived snapshot to stdout',
+                            type=int,
+                            default=None)
+        parser.add_argument('--check-archive',
+                            help='exit 0 if the config archives, else 1',
+                            action='store_true',
+                            dest='checkarchive')
+        parser.add_argument('--async-log',
+                            help='write the log from a background thread',
+                            action='store_true',
+                            dest='asynclog')
+        parser.add_argument('--log-limit',
+                            help='maximum new messages to log (0 for all)',
+                            type=int,
+                            default=0,
+                            dest='loglimit')
         args = parser.parse_args()
         handler = logging.handlers.RotatingFileHandler(args.log,
                                                        maxBytes=10*1024*1024,
                                                        backupCount=10)
         handler.setFormatter(formatter)
-        logger.addHandler(handler)
+        handlers = [handler]
         if args.debug:
             logger.setLevel(logging.DEBUG)
             console_handler = logging.StreamHandler()
             console_handler.setFormatter(formatter)
-            logger.addHandler(console_handler)
+            handlers.append(console_handler)
+
+        if args.asynclog:
+            # Records are queued and written out by the listener's thread
+            log_queue = queue.Queue(-1)
+            logger.addHandler(logging.handlers.QueueHandler(log_queue))
+            listener = logging.handlers.QueueListener(log_queue, *handlers)
+            listener.start()
+        else:
+            for item in handlers:
+                logger.addHandler(item)
 
         logger.info("script version %s" % VERSION_NUMBER)
-        bytes = _get_data_bytes(logger, args.file, args.test)
-        config_file = None
-        with open(args.config, 'r') as f:
-            logger.debug('loading config')
-            config_file = json.loads(f.read())
-            logger.debug(config_file)
-
-        if SHARED_KEY in config_file:
-            shared_value = config_file[SHARED_KEY]
-            logger.debug('loading shared config')
-            if len(shared_value) > 0:
-                with open(shared_value, 'r') as f:
-                    shared_config = json.loads(f.read())
-                    logger.debug(shared_config)
-                    do_override = True
-                    if OVERRIDE_KEY in config_file:
-                        do_override = config_file[OVERRIDE_KEY]
-
-                    # Replay this 'over' the given, it overrides
-                    config_file = overriding(shared_config,
-                                             config_file,
-                                             do_override,
-                                             logger)
-
-        check_parameter(SIZE_KEY, config_file)
-        check_parameter(START_KEY, config_file, '1970-01-01 00:00:00')
-        check_parameter(PATTERN_KEY, config_file)
-        check_parameter(MESSAGE_KEY, config_file)
-        check_parameter(TIME_KEY, config_file)
-        check_parameter(CACHE_KEY, config_file)
-        check_parameter(WHITELIST_KEY, config_file, [])
-        check_parameter(BLACKLIST_KEY, config_file, [])
-        logger.debug('final config:')
-        logger.debug(config_file)
+        configs = [_load_config(logger, x) for x in args.config]
+        _check_shared(configs)
+
+        if args.checkarchive:
+            archiving = len([x for x in configs if ARCHIVE_KEY in x]) > 0
+            logger.info('archiving? %s' % archiving)
+            _done(logger, 0 if archiving else 1, listener)
+
+        if args.restore is not None:
+            if len(configs) > 1:
+                raise Exception("only one config can be used to restore")
+            check_parameter(ARCHIVE_KEY, configs[0])
+            restored = restore_snapshot(logger, configs[0], args.restore)
+            sys.stdout.buffer.write(restored)
+            sys.stdout.flush()
+            _done(logger, 0, listener)
+
+        active = []
+        for config_file in configs:
+            lease_token = None
+            if LEASE_KEY in config_file:
+                lease_token = acquire_lease(logger, config_file)
+                if lease_token is None:
+                    continue
+            active.append((config_file, lease_token))
 
-        last_obj = None
-        cache = config_file[CACHE_KEY]
-        logger.debug('using cache: %s' % cache)
-        if os.path.exists(cache) and not args.force:
-            with open(cache, 'r') as cache_file:
-                last_obj = json.loads(cache_file.read())
-                logger.info('reading cache in, object: ')
-                logger.info(last_obj)
-
-        results = process_file(logger, bytes, last_obj, config_file)
-        results.sort(key=lambda x: x[OBJECT_TIME], reverse=True)
-        messages = []
-        latest_message = None
-        for item in results:
-            if latest_message is None:
-                latest_message = item
+        if len(active) == 0:
+            # Standby, only check on the file (the holder will scan)
+            if args.file is not None:
+                stat = os.stat(args.file)
+                logger.info('standby for {0} ({1} bytes)'.format(
+                    args.file,
+                    stat.st_size))
+            _done(logger, 0, listener)
 
-            logger.debug(item)
-            message_text = item[OBJECT_MESSAGE]
-            logger.warn(message_text)
-            messages.append(message_text)
+        bytes = _get_data_bytes(logger, args.file, args.test)
 
-        if len(messages) > 0:
-            dry_run = args.dryrun
-            locking = LOCK_KEY in config_file
-            lock_file = None
-            if locking:
-                lock_file = config_file[LOCK_KEY]
-                if not os.path.exists(lock_file):
-                    logger.info('creating lock file %s' % lock_file)
-                    # Creating the file if it doesn't exist
-                    with open(lock_file, 'w+') as fd:
-                        fd.write('')
-
-            fd = None
+        rule_sets = []
+        for config_file, lease_token in active:
+            last_obj = _read_cache(logger,
+                                   config_file,
+                                   args.force,
+                                   lease_token)
+            rule_sets.append((last_obj, config_file))
+        all_results = process_files(logger, bytes, rule_sets)
+        failed = False
+        for results, (config_file, lease_token) in zip(all_results, active):
             try:
-                if locking:
-                    logger.debug('performing lock operation')
-                    fd = open(lock_file, 'w')
-                    fcntl.lockf(fd.fileno(), fcntl.LOCK_EX)
-
-                # Critical section for messaging outputs
-                if args.console:
-                    config_file[CONSOLE_SECTION] = {}
-                if not send_message(logger, messages, config_file, dry_run):
-                    # Prevent writing out the 'latest' if this doesn't work
-                    raise Exception("unable to report message out")
-            finally:
-                if locking and fd is not None:
-                    logger.debug('unlocking...')
-                    fcntl.lockf(fd.fileno(), fcntl.LOCK_UN)
-                    fd.close()
-
-        if latest_message is not None:
-            logger.info('new message detected')
-            last_json = json.dumps(latest_message)
-            logger.info(last_json)
-            with open(cache, 'w') as cache_write:
-                cache_write.write(last_json)
-
-        exit_code = 0
+                _report(logger, args, config_file, results, lease_token)
+            except Exception as e:
+                # Keep reporting for any other configs
+                print(e)
+                logger.error(e)
+                failed = True
+
+        # Archiving is after reporting, so it can never block messaging
+        for config_file, _ in active:
+            if ARCHIVE_KEY in config_file and args.file is not None:
+                try:
+                    snapshot = archive_snapshot(logger, bytes, config_file)
+                    logger.info('archived snapshot %s' % snapshot)
+                except Exception as e:
+                    print(e)
+                    logger.error('unable to archive: %s', e)
+                    failed = True
+
+        if not failed:
+            exit_code = 0
     except Exception as e:
         # Non-zero exit and make sure to output everything
         print(e)
         logger.error(e)
-    logger.info('done')
-    exit(exit_code)
+    _done(logger, exit_code, listener)
 
 if __name__ == "__main__":
     main()
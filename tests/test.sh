@@ -14,6 +14,9 @@ FILTER_TESTS=0
 NORMAL_TESTS=0
 OVERRIDE_TESTS=0
 TYPE_TESTS=0
+ARCHIVE_TESTS=0
+LEASE_TESTS=0
+FANOUT_TESTS=0
 
 if [ -z "$ARGS" ]; then
     CACHE_TESTS=$RUN_TEST
@@ -21,6 +24,9 @@ if [ -z "$ARGS" ]; then
     NORMAL_TESTS=$RUN_TEST
     OVERRIDE_TESTS=$RUN_TEST
     TYPE_TESTS=$RUN_TEST
+    ARCHIVE_TESTS=$RUN_TEST
+    LEASE_TESTS=$RUN_TEST
+    FANOUT_TESTS=$RUN_TEST
 else
     case $ARGS in
         "--filter")
@@ -39,6 +45,15 @@ else
         "--types")
             TYPE_TESTS=$RUN_TEST
             ;;
+        "--archive")
+            ARCHIVE_TESTS=$RUN_TEST
+            ;;
+        "--lease")
+            LEASE_TESTS=$RUN_TEST
+            ;;
+        "--fanout")
+            FANOUT_TESTS=$RUN_TEST
+            ;;
         *)
             echo "Unknown argument: $ARGS"
             exit -1
@@ -95,6 +110,22 @@ URL_CONFIG="url"
 CONSOLE_CONFIG="console"
 CONSOLE_ONLY_CONFIG="console-only"
 
+# Archive config
+ARCHIVE_CONFIG="archive"
+ARCHIVE_DIR="archive"
+ARCHIVE_DAT="archive.dat"
+ARCHIVE_SNAPSHOT="snapshot.dat"
+ARCHIVE_INDEX="$ARCHIVE_DIR/index.jsonl"
+
+# Lease config
+LEASE_PRIMARY_CONFIG="lease-primary"
+LEASE_STANDBY_CONFIG="lease-standby"
+LEASE_JSON="$LAST_JSON.lease"
+
+# Fan out (multiple configs) config
+FANOUT_CONFIG="fanout"
+FANOUT_JSON="fanout.json"
+
 # Testing commands
 FORCE_CMD="--force"
 CONSOLE_CMD="--console"
@@ -191,7 +222,33 @@ CONSOLE_FILE=$(echo "$CONFIG_FILE" | head -n -1)",
 
 CONSOLE_ONLY="{"$(echo "$CONFIG_FILE" | tail -n -7)
 
-EXAMPLE_FILE=$(cat ../example.json | sed "s/\/path\/to\/cache\/last\/detected\///g" | sed "s/\/path\/to\/file\/to\/lock/lock.json/g" | sed "s/\/path\/to\/a\/shared\/config.json//g")
+ARCHIVE_FILE=$(echo "$CONFIG_FILE" | head -n -1)",
+    \"archive\":
+    {
+        \"path\": \"$ARCHIVE_DIR\",
+        \"compress\": true,
+        \"retain\": 7,
+        \"fold\": 2
+    }
+}"
+
+LEASE_PRIMARY_FILE=$(echo "$CONFIG_FILE" | head -n -1)",
+    \"lease\":
+    {
+        \"ttl\": 60,
+        \"owner\": \"primary\"
+    }
+}"
+
+LEASE_STANDBY_FILE=$(echo "$LEASE_PRIMARY_FILE" | sed "s/primary/standby/g")
+
+FANOUT_FILE="{
+    \"blacklist\":[\"$CACHE_MSG\"],
+    \"cache\":\"$FANOUT_JSON\",
+    \"shared\": \"$(get-config-name $DEFAULT_CONFIG)\"
+}"
+
+EXAMPLE_FILE=$(cat ../example.json | sed "s/\/path\/to\/cache\/last\/detected\///g" | sed "s/\/path\/to\/file\/to\/lock/lock.json/g" | sed "s/\/path\/to\/a\/shared\/config.json//g" | sed "s/\/path\/to\/archive\/directory/$ARCHIVE_DIR/g")
 
 PHONE_CONFIG=$(echo "$CONFIG_FILE" | sed "s/\"sms\"/\"other\"/g")
 SMS_CONFIG=$(echo "$CONFIG_FILE" | sed "s/\"call\"/\"other\"/g")
@@ -317,6 +374,9 @@ function override-test()
 # Cleanup and setup before any and all tests
 rm -f *.log
 rm -f *.json
+rm -f $ARCHIVE_DAT $ARCHIVE_SNAPSHOT
+rm -f *.lease *.lease.lock
+rm -rf $ARCHIVE_DIR
 save-config "$CONFIG_FILE" $DEFAULT_CONFIG
 save-config "$FILTER_FILE" $FILTER_CONFIG
 save-config "$PHONE_CONFIG" $PHONE
@@ -328,6 +388,10 @@ save-config "$WHITEANDBLACKLIST_FILE" $WHITEBLACK_CONFIG
 save-config "$URL_FILE" $URL_CONFIG
 save-config "$CONSOLE_FILE" $CONSOLE_CONFIG
 save-config "$CONSOLE_ONLY" $CONSOLE_ONLY_CONFIG
+save-config "$ARCHIVE_FILE" $ARCHIVE_CONFIG
+save-config "$LEASE_PRIMARY_FILE" $LEASE_PRIMARY_CONFIG
+save-config "$LEASE_STANDBY_FILE" $LEASE_STANDBY_CONFIG
+save-config "$FANOUT_FILE" $FANOUT_CONFIG
 
 if [ $NORMAL_TESTS -eq $RUN_TEST ]; then
     echo "Message test..."
@@ -357,6 +421,22 @@ if [ $NORMAL_TESTS -eq $RUN_TEST ]; then
     results=$(run-test "$EXAMPLE_CONFIG")
     check-all-content "$results" "$NORMAL_MSG" "$URL"
     normal-cache
+
+    echo "Logging test (async, limited)..."
+    rm -f binlogmon.log
+    results=$(run-test "$DEFAULT_CONFIG" $FORCE_CMD --async-log --log-limit 1)
+    check-all-content "$results" "$NORMAL_MSG" "$URL"
+    normal-cache
+    grep -q "WARNING - $CACHE_MSG" binlogmon.log
+    if [ $? -ne 0 ] || [ $(grep -c "WARNING - $FILTER_CACHE_MSG" binlogmon.log) -ne 0 ]; then
+        echo "FAILED - should only log the first new message"
+        exit -1
+    fi
+    grep -q "2 more new messages" binlogmon.log
+    if [ $? -ne 0 ] || [ $(tail -n 1 binlogmon.log | grep -c "done") -ne 1 ]; then
+        echo "FAILED - should log remaining count and flush the log"
+        exit -1
+    fi
 fi
 
 function console-test()
@@ -455,3 +535,228 @@ if [ $OVERRIDE_TESTS -eq $RUN_TEST ]; then
     echo "Override test..."
     override-test "$OVERRIDE_ALT"
 fi
+
+# Check a restored snapshot matches (snapshot id, expected file)
+function check-restore()
+{
+    binlogmon --config $(get-config-name $ARCHIVE_CONFIG) --restore $1 > $ARCHIVE_SNAPSHOT
+    cmp -s $ARCHIVE_SNAPSHOT $2
+    if [ $? -ne 0 ]; then
+        echo "FAILED restoring snapshot $1"
+        exit -1
+    fi
+}
+
+# Snapshot ids in the archive (optionally only bases)
+function archive-ids()
+{
+    python -c "import json; print(' '.join(str(x['id']) for x in map(json.loads, open('$ARCHIVE_INDEX')) if '$1' == '' or x['base']))"
+}
+
+# Seed an archive with an expired base and delta (old, unrelated log)
+# and a chain of test.dat's records: two expired and one retained
+function seed-archive()
+{
+    rm -rf $ARCHIVE_DIR
+    mkdir -p $ARCHIVE_DIR
+    python - <<EOF
+import binascii, json, time
+data = open('test.dat', 'rb').read()
+now = int(time.time())
+segments = [(1000, b'old log', 0, True),
+            (1001, b'more', 7, False),
+            (2000, data[0:11], 0, True),
+            (2001, data[11:22], 11, False),
+            (now - 60, data[22:33], 22, False)]
+with open('$ARCHIVE_INDEX', 'w') as index:
+    for snapshot, raw, offset, base in segments:
+        name = 'seg-{0}.bin'.format(snapshot)
+        open('$ARCHIVE_DIR/' + name, 'wb').write(raw)
+        end = offset + len(raw)
+        tail = data[0:end] if snapshot >= 2000 else b'old logmore'
+        index.write(json.dumps({'id': snapshot,
+                                'offset': offset,
+                                'length': len(raw),
+                                'base': base,
+                                'tail': binascii.hexlify(tail).decode(),
+                                'file': name}) + '\\n')
+print(now - 60)
+EOF
+}
+
+if [ $ARCHIVE_TESTS -eq $RUN_TEST ]; then
+    echo "Archive test..."
+    rm -rf $ARCHIVE_DIR
+    rm -f $LAST_JSON
+    cp test.dat $ARCHIVE_DAT
+    results=$(execute-run "$ARCHIVE_CONFIG" "-f $ARCHIVE_DAT")
+    check-all-content "$results" "$NORMAL_MSG" "$URL"
+    cp $ARCHIVE_DAT $ARCHIVE_SNAPSHOT.first
+    head -c 11 test.dat >> $ARCHIVE_DAT
+    results=$(execute-run "$ARCHIVE_CONFIG" "-f $ARCHIVE_DAT")
+    segments=$(ls $ARCHIVE_DIR | grep "\.bin\.gz$" | wc -l)
+    if [ $segments -ne 2 ]; then
+        echo "FAILED - should have a base and a delta segment"
+        exit -1
+    fi
+    snapshots=$(archive-ids)
+    check-restore $(echo $snapshots | cut -d " " -f 1) $ARCHIVE_SNAPSHOT.first
+    check-restore $(echo $snapshots | cut -d " " -f 2) $ARCHIVE_DAT
+
+    echo "Archive test (rewritten log)..."
+    cp test.dat $ARCHIVE_DAT
+    results=$(execute-run "$ARCHIVE_CONFIG" "-f $ARCHIVE_DAT")
+    snapshots=$(archive-ids "base")
+    if [ $(echo $snapshots | wc -w) -ne 2 ]; then
+        echo "FAILED - rewritten log should be a new base"
+        exit -1
+    fi
+    check-restore $(echo $snapshots | cut -d " " -f 2) test.dat
+    rm -f $ARCHIVE_SNAPSHOT.first
+
+    echo "Archive test (expiry)..."
+    retained=$(seed-archive)
+    cp test.dat $ARCHIVE_DAT
+    head -c 11 test.dat >> $ARCHIVE_DAT
+    results=$(execute-run "$ARCHIVE_CONFIG" "-f $ARCHIVE_DAT")
+    snapshots=$(archive-ids)
+    if [[ "$(echo $snapshots | cut -d " " -f 1)" != "$retained" ]] || [ $(echo $snapshots | wc -w) -ne 2 ]; then
+        echo "$snapshots"
+        echo "FAILED - expired snapshots should be removed"
+        exit -1
+    fi
+    for expired in 1000 1001 2000 2001 $retained; do
+        if [ -e $ARCHIVE_DIR/seg-$expired.bin ]; then
+            echo "FAILED - expired segment $expired should be removed"
+            exit -1
+        fi
+    done
+    check-restore $retained test.dat
+    check-restore $(echo $snapshots | cut -d " " -f 2) $ARCHIVE_DAT
+
+    echo "Archive test (check)..."
+    binlogmon --config $(get-config-name $ARCHIVE_CONFIG) --check-archive
+    if [ $? -ne 0 ]; then
+        echo "FAILED - archive config should be archiving"
+        exit -1
+    fi
+    binlogmon --config $(get-config-name $DEFAULT_CONFIG) --check-archive
+    if [ $? -ne 1 ]; then
+        echo "FAILED - default config should not be archiving"
+        exit -1
+    fi
+
+    echo "Archive test (failure)..."
+    rm -rf $ARCHIVE_DIR
+    rm -f $LAST_JSON
+    touch $ARCHIVE_DIR
+    results=$(execute-run "$ARCHIVE_CONFIG" "-f test.dat")
+    check-all-content "$results" "$NORMAL_MSG" "$URL"
+    normal-cache
+    rm -f $ARCHIVE_DIR
+fi
+
+# Check the lease record (owner, token)
+function check-lease()
+{
+    contents=$(cat $LEASE_JSON)
+    check-cache-value "$contents" "owner" "\"$1\""
+    check-cache-value "$contents" "token" "$2"
+}
+
+if [ $LEASE_TESTS -eq $RUN_TEST ]; then
+    echo "Lease test..."
+    rm -f $LEASE_JSON
+    results=$(run-test "$LEASE_PRIMARY_CONFIG")
+    check-all-content "$results" "$NORMAL_MSG" "$URL"
+    normal-cache
+    check-lease "primary" 1
+
+    echo "Lease test (standby)..."
+    rm -f $LAST_JSON
+    results=$(execute-run "$LEASE_STANDBY_CONFIG" "-f test.dat")
+    if [[ "$results" != "" ]]; then
+        echo "FAILED - standby should not output"
+        exit -1
+    fi
+    if [ -e $LAST_JSON ]; then
+        echo "FAILED - standby should not write the cache"
+        exit -1
+    fi
+    check-lease "primary" 1
+
+    echo "Lease test (failover)..."
+    results=$(run-test "$LEASE_PRIMARY_CONFIG")
+    normal-cache
+    python -c "import json; l = json.load(open('$LEASE_JSON')); l['expires'] = 0; json.dump(l, open('$LEASE_JSON', 'w'))"
+    results=$(execute-run "$LEASE_STANDBY_CONFIG" "-f test.dat")
+    if [[ "$results" != "" ]]; then
+        echo "FAILED - cache should prevent sending messages again"
+        exit -1
+    fi
+    check-lease "standby" 2
+    results=$(execute-run "$LEASE_PRIMARY_CONFIG" "-f test.dat")
+    check-lease "standby" 2
+    check-cache-value "$(cat $LAST_JSON)" "token" 1
+
+    echo "Lease test (fencing)..."
+    python -c "import json; c = json.load(open('$LAST_JSON')); c['token'] = 5; c['time'] = 0; json.dump(c, open('$LAST_JSON', 'w'))"
+    results=$(execute-run "$LEASE_STANDBY_CONFIG" "-f test.dat")
+    echo "$results" | grep -q "newer lease"
+    if [ $? -ne 0 ] || [ $(echo "$results" | grep -c "$NUMBER1") -ne 0 ]; then
+        echo "$results"
+        echo "FAILED - should not send from a cache with a newer token"
+        exit -1
+    fi
+
+    echo "Lease test (lost lease)..."
+    rm -f $LEASE_JSON
+    results=$(execute-run "$LEASE_PRIMARY_CONFIG" "-f test.dat")
+    check-all-content "$results" "$NORMAL_MSG" "$URL"
+    normal-cache
+    check-lease "primary" 6
+    check-cache-value "$(cat $LAST_JSON)" "token" 6
+fi
+
+if [ $FANOUT_TESTS -eq $RUN_TEST ]; then
+    echo "Fan out test..."
+    rm -f $LAST_JSON $FANOUT_JSON
+    results=$(binlogmon -f test.dat --config $(get-config-name $DEFAULT_CONFIG) $(get-config-name $FANOUT_CONFIG) --dry-run)
+    check-all-content "$results" "$NORMAL_MSG" "$URL"
+    check-all-content "$results" "$FILTER_CACHE_MSG$FILTER_ALL_LONG" "$URL"
+    normal-cache
+    contents=$(cat $FANOUT_JSON)
+    check-cache-value "$contents" "time" "$FILTER_CACHE_TIME"
+    check-cache-value "$contents" "message" "\"$FILTER_CACHE_MSG\""
+
+    echo "Fan out test (cached)..."
+    sed -i -- "s/$FILTER_CACHE_TIME/$((FILTER_CACHE_TIME - 1))/g" $FANOUT_JSON
+    results=$(binlogmon -f test.dat --config $(get-config-name $DEFAULT_CONFIG) $(get-config-name $FANOUT_CONFIG) --dry-run)
+    check-all-content "$results" "$FILTER_CACHE_MSG$SHORT_SMS" "$URL"
+    if [ $(echo "$results" | grep -c "$CACHE_MSG") -ne 0 ]; then
+        echo "FAILED - cached config should not output again"
+        exit -1
+    fi
+
+    echo "Fan out test (shared cache)..."
+    rm -f $LAST_JSON
+    results=$(binlogmon -f test.dat --config $(get-config-name $DEFAULT_CONFIG) $(get-config-name $FILTER_CONFIG) --dry-run)
+    echo "$results" | grep -q "can not share a cache"
+    if [ $? -ne 0 ] || [ -e $LAST_JSON ]; then
+        echo "$results"
+        echo "FAILED - configs sharing a cache should be rejected"
+        exit -1
+    fi
+
+    echo "Fan out test (layout)..."
+    rm -f $LAST_JSON $LEASE_JSON $FANOUT_JSON
+    sed "s/\"size\":11/\"size\":12/g" $(get-config-name $DEFAULT_CONFIG) > $(get-config-name $FANOUT_CONFIG)
+    sed -i "s/$LAST_JSON/$FANOUT_JSON/g" $(get-config-name $FANOUT_CONFIG)
+    results=$(binlogmon -f test.dat --config $(get-config-name $LEASE_PRIMARY_CONFIG) $(get-config-name $FANOUT_CONFIG) --dry-run)
+    echo "$results" | grep -q "record layout: size"
+    if [ $? -ne 0 ] || [ -e $LEASE_JSON ] || [ -e $LAST_JSON ]; then
+        echo "$results"
+        echo "FAILED - configs with different layouts should be rejected first"
+        exit -1
+    fi
+fi
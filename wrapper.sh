@@ -1,16 +1,27 @@
 #!/bin/bash
 LOCATION=$PWD/$NAME
 PATH_TO_LOGS=$LOG_FILES
+CONFIG="$LOCATION/config-$NAME.json"
+LOG="$LOCATION/log-$NAME.log"
+
+if binlogmon --config "$CONFIG" --log "$LOG" --check-archive; then
+    # The log is read once and each run's appended records are archived
+    # (see 'archive' in the config), retention is handled by binlogmon
+    binlogmon -f "$PATH_TO_LOGS" --config "$CONFIG" --log "$LOG"
+    exit $?
+fi
 
 # Share location of the log file, we'll copy it before doing any reading
-PAST_LOGS=$LOCATION/logs-$NAME/
-mkdir -p $PAST_LOGS
+PAST_LOGS="$LOCATION/logs-$NAME/"
+mkdir -p "$PAST_LOGS"
 TIMESTAMP=$(date +%s)
-LOG_COPY=$PAST_LOGS$TIMESTAMP.log
+LOG_COPY="$PAST_LOGS$TIMESTAMP.log"
 
 # Prep for actual execution
-cp $PATH_TO_LOGS $LOG_COPY
-binlogmon -f $LOG_COPY --config $LOCATION/config-$NAME.json --log $LOCATION/log-$NAME.log
+cp "$PATH_TO_LOGS" "$LOG_COPY"
+binlogmon -f "$LOG_COPY" --config "$CONFIG" --log "$LOG"
+RESULT=$?
 
 # Cleanup
-find $PAST_LOGS* -mtime +7 -exec rm {} \;
+find "$PAST_LOGS" -type f -mtime +7 -exec rm {} \;
+exit $RESULT